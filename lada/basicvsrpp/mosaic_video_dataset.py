@@ -26,6 +26,11 @@ class MosaicVideoDataset(data.Dataset):
         self.meta_root = Path(opt['metadata_root_dir'])
         self.use_hflip = opt.get('use_hflip', False)
         self.degrade = opt.get('degrade', False)
+        # needs a PyAV built against an FFmpeg with NVENC support, the PyAV wheels don't include it
+        self.degrade_use_nvenc = opt.get('degrade_use_nvenc', False)
+        if self.degrade_use_nvenc and not degradation_utils.is_nvenc_available():
+            raise Exception("degrade_use_nvenc is set but PyAV has no h264_nvenc/hevc_nvenc encoders. Install PyAV built against an FFmpeg with NVENC support")
+        self.degrade_video_compression_cache_bytes = opt.get('degrade_video_compression_cache_bytes', 0)
         self.max_frame_count = opt['num_frame']
         self.min_frame_count = opt['min_num_frame'] if 'min_num_frame' in opt else opt['num_frame']
         self.random_mosaic_params = opt.get('random_mosaic_params', True)
@@ -101,7 +106,9 @@ class MosaicVideoDataset(data.Dataset):
                                                  feather=mosaic_feather_size)
                 img_lqs.append(pad_image_by_pad(img_lq, pad))
             if self.degrade:
-                degradation_params = MosaicRandomDegradationParamsV2(repeatable_random=self.repeatable_random)
+                # the cache lives in the DataLoader worker process so it has to be enabled here instead of in __init__
+                degradation_utils.set_video_compression_cache_size(self.degrade_video_compression_cache_bytes)
+                degradation_params = MosaicRandomDegradationParamsV2(repeatable_random=self.repeatable_random, use_nvenc=self.degrade_use_nvenc)
                 img_lqs = video_utils.resize_video_frames(img_lqs, self.lq_size)
                 img_lqs = apply_video_degradation_v2(img_lqs, degradation_params)
                 if degradation_params.should_run_video_compression_second_pass:
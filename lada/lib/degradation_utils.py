@@ -1,72 +1,190 @@
-import io
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+
 import av
 import cv2
 import numpy as np
 
 from lada.lib import Image, random_utils
 from lada.lib import video_utils
-from lada.lib.degradations import generate_gaussian_noise, add_jpg_compression, random_mixed_kernels
+from lada.lib.degradations import generate_gaussian_noise, random_mixed_kernels
 
+# capped like the encoder threads as each DataLoader worker gets its own pool
+_FRAME_DEGRADATION_THREADS = min(4, os.cpu_count() or 1)
+_frame_degradation_pool = None
+_frame_degradation_pool_pid = None
 
-def apply_video_compression(imgs: list[Image], codec, bitrate, crf=None):
-    imgs = video_utils.pad_to_compatible_size_for_video_codecs(imgs)
+def _get_frame_degradation_pool() -> ThreadPoolExecutor:
+    # created lazily and per process: a pool inherited via fork (e.g. by DataLoader workers) has no live threads
+    global _frame_degradation_pool, _frame_degradation_pool_pid
+    if _frame_degradation_pool is None or _frame_degradation_pool_pid != os.getpid():
+        _frame_degradation_pool = ThreadPoolExecutor(max_workers=_FRAME_DEGRADATION_THREADS)
+        _frame_degradation_pool_pid = os.getpid()
+    return _frame_degradation_pool
+
+def _map_frames(frame_degradation_fn, imgs: list[Image], degradation_params, parallel=True) -> list[Image]:
+    # frames are independent and OpenCV releases the GIL so threads scale with cores.
+    # degradation_params is shared by all workers and must be treated as read-only
+    if not parallel or len(imgs) < 2:
+        return [frame_degradation_fn(img, degradation_params) for img in imgs]
+    return list(_get_frame_degradation_pool().map(lambda img: frame_degradation_fn(img, degradation_params), imgs))
+
+class _VideoCompressionCache:
+    """
+    LRU cache of compressed clips bounded by the size of the cached frames.
+    Compression is deterministic for given frames and codec settings, so this avoids re-encoding when the same clip gets degraded again
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, imgs: list[Image], *settings) -> tuple:
+        digest = hashlib.blake2b(digest_size=16)
+        for img in imgs:
+            digest.update(np.ascontiguousarray(img).data)
+        return digest.digest(), len(imgs), imgs[0].shape, *settings
+
+    def get(self, key) -> np.ndarray | None:
+        with self._lock:
+            imgs = self._entries.get(key)
+            if imgs is None:
+                return None
+            self._entries.move_to_end(key)
+            return imgs.copy()
+
+    def put(self, key, imgs: np.ndarray):
+        with self._lock:
+            if key in self._entries or imgs.nbytes > self.max_bytes:
+                return
+            self._entries[key] = imgs.copy()
+            self._size += imgs.nbytes
+            while self._size > self.max_bytes:
+                _, evicted_imgs = self._entries.popitem(last=False)
+                self._size -= evicted_imgs.nbytes
+
+_video_compression_cache = _VideoCompressionCache()
+
+def set_video_compression_cache_size(max_bytes: int):
+    """
+    Enables caching of compressed clips in apply_video_compression if max_bytes > 0. Disabled by default as hashing the frames
+    is wasted work if clips are not re-used, e.g. when mosaic parameters are randomized for each sample.
+    The cache is per process. Calling it again with the same size keeps the current cache.
+    """
+    global _video_compression_cache
+    if _video_compression_cache.max_bytes != max_bytes:
+        _video_compression_cache = _VideoCompressionCache(max_bytes)
+
+def apply_video_compression(imgs: list[Image], codec, bitrate, crf=None, preset='ultrafast'):
     h, w = imgs[0].shape[:2]
-    degraded_imgs = _apply_video_compression(imgs, codec, bitrate, crf)
-    return [img[0:h, 0:w, :] for img in degraded_imgs]
+    imgs = video_utils.pad_to_compatible_size_for_video_codecs(imgs)
+    cache = _video_compression_cache
+    cache_key = cache.key(imgs, codec, bitrate, crf, preset) if cache.max_bytes > 0 else None
+    degraded_imgs = cache.get(cache_key) if cache_key else None
+    if degraded_imgs is None:
+        degraded_imgs = _apply_video_compression(imgs, codec, bitrate, crf, preset)
+        if cache_key: cache.put(cache_key, degraded_imgs)
+    return list(degraded_imgs[:, 0:h, 0:w, :])
+
+_ENCODER_THREADS = str(min(4, os.cpu_count() or 1))
+
+_NVENC_CODECS = ('h264_nvenc', 'hevc_nvenc')
+
+def is_nvenc_available() -> bool:
+    # PyAV wheels (like the pinned av==13.1.0) ship an FFmpeg without NVENC, a CUDA device alone is not enough
+    return all(codec in av.codecs_available for codec in _NVENC_CODECS)
 
-def _apply_video_compression(imgs: list[Image], codec, bitrate, crf=None):
+# decoders for encoders whose name differs from the name of the codec they produce
+_DECODER_NAMES = {
+    'libx264': 'h264',
+    'libx265': 'hevc',
+    'libvpx-vp9': 'vp9',
+    'h264_nvenc': 'h264',
+    'hevc_nvenc': 'hevc',
+}
+
+def _apply_video_compression(imgs: list[Image], codec, bitrate, crf=None, preset='ultrafast'):
     # source: https://mmagic.readthedocs.io/en/latest/_modules/mmagic/datasets/transforms/random_degradations.html#RandomVideoCompression.__call__
     """This is the function to apply random compression on images.
 
+    Packets are passed straight from the encoder to a decoder instead of muxing into and demuxing from an
+    in-memory mp4 container.
+
     Args:
         imgs (list of ndarray): training images
+        preset (str): x264/x265 preset. We're only after the compression artifacts, not compression efficiency,
+            so this defaults to the cheapest one. Ignored by other codecs. NVENC codecs use their fastest preset p1.
 
     Returns:
-        Tensor: images after randomly compressed
+        ndarray: images after randomly compressed, shape (N, H, W, 3)
     """
 
-    buf = io.BytesIO()
-    with av.open(buf, 'w', 'mp4') as container:
-        options = {}
-        if crf: options["crf"] = str(crf)
-        if codec == 'libx265': options['x265-params'] = 'log_level=error'
-        if codec == 'libx264' or codec == 'libx265': options['preset'] = 'veryfast'
-        stream = container.add_stream(codec, rate=1, options=options)
-        stream.height = imgs[0].shape[0]
-        stream.width = imgs[0].shape[1]
-        stream.pix_fmt = 'yuv420p'
-        if bitrate: stream.bit_rate = bitrate
+    options = {}
+    if codec in _NVENC_CODECS:
+        options.update({'preset': 'p1', 'rc': 'vbr'})
+        if crf: options['cq'] = str(crf)
+    elif crf: options["crf"] = str(crf)
+    if codec == 'libx265': options['x265-params'] = f'log_level=error:wpp=1:pools={_ENCODER_THREADS}:frame-threads={_ENCODER_THREADS}'
+    if codec == 'libx264' or codec == 'libvpx-vp9': options['threads'] = _ENCODER_THREADS
+    if codec == 'libvpx-vp9': options['row-mt'] = '1'
+    if codec == 'libx264' or codec == 'libx265': options['preset'] = preset
+    encoder = av.CodecContext.create(codec, 'w')
+    encoder.height = imgs[0].shape[0]
+    encoder.width = imgs[0].shape[1]
+    encoder.pix_fmt = 'yuv420p'
+    encoder.time_base = Fraction(1, 1)
+    encoder.framerate = Fraction(1, 1)
+    if bitrate: encoder.bit_rate = bitrate
+    if codec == 'libx264': encoder.thread_type = 'FRAME'
+    encoder.options = options
 
-        for img in imgs:
-            frame = av.VideoFrame.from_ndarray(img, format='rgb24')
-            frame.pict_type = av.video.frame.PictureType.NONE
-            for packet in stream.encode(frame):
-                container.mux(packet)
+    decoder = av.CodecContext.create(_DECODER_NAMES.get(codec, codec), 'r')
+
+    # decoded frames are written into a single block instead of allocating each frame separately
+    outputs = np.empty((len(imgs), encoder.height, encoder.width, 3), dtype=np.uint8)
+    decoded_count = 0
+    def decode(packets):
+        nonlocal decoded_count
+        for packet in packets:
+            for frame in decoder.decode(packet):
+                outputs[decoded_count] = frame.to_ndarray(format='rgb24')
+                decoded_count += 1
 
-        # Flush stream
-        for packet in stream.encode():
-            container.mux(packet)
+    for i, img in enumerate(imgs):
+        frame = av.VideoFrame.from_ndarray(img, format='rgb24')
+        frame.pts = i
+        decode(encoder.encode(frame))
 
-    outputs = []
-    with av.open(buf, 'r', 'mp4') as container:
-        if container.streams.video:
-            for frame in container.decode(**{'video': 0}):
-                img = frame.to_rgb().to_ndarray().astype(np.uint8)
-                outputs.append(img)
+    # Flush encoder and decoder
+    decode(encoder.encode(None))
+    decode([None])
 
-    return outputs
+    return outputs[:decoded_count]
 
 class MosaicRandomDegradationParamsV2:
-    def __init__(self, repeatable_random=False):
+    def __init__(self, repeatable_random=False, use_nvenc=False):
         rng_random, self._rng_numpy = random_utils.get_rngs(repeatable_random)
         codecs = {
             'libx264': (16, 28),
             'libx265': (20, 36),
             'libvpx-vp9': (6_000, 16_000),
             'mpeg2video': (18_000, 40_000),
+            'h264_nvenc': (19, 35),
+            'hevc_nvenc': (19, 35),
         }
         available_codecs = ['libx264', 'libx265', 'libvpx-vp9', 'mpeg2video']
         codec_probabilities = [0.3, 0.3, 0.3, 0.1]
+        if use_nvenc:
+            # requires a PyAV built against an FFmpeg with NVENC support (see is_nvenc_available()) and a CUDA device.
+            # artifacts of NVENC differ a bit from x264/x265 so CPU codecs are still used most of the time
+            available_codecs += list(_NVENC_CODECS)
+            codec_probabilities = [0.2, 0.2, 0.3, 0.1, 0.1, 0.1]
         self.video_codec = str(self._rng_numpy.choice(available_codecs, p=codec_probabilities))
         value = self._rng_numpy.randint(codecs[self.video_codec][0], codecs[self.video_codec][1] + 1)
         if self.video_codec in ('libvpx-vp9', 'mpeg2video'):
@@ -78,8 +196,13 @@ class MosaicRandomDegradationParamsV2:
         self.should_add_video_compression = rng_random.random()<0.9
         self.blur_sigma = self._rng_numpy.randint(1, 4)
         self.should_add_blur = rng_random.random()<0.3
+        # computed once per clip instead of letting cv2.GaussianBlur recreate it for every frame
+        self.blur_kernel = cv2.getGaussianKernel(13, self.blur_sigma, ktype=cv2.CV_32F) if self.should_add_blur else None
         self.should_add_noise = rng_random.random()<0.2
         self.should_run_video_compression_second_pass = rng_random.random()<0.15
+        # mostly use the cheapest preset but keep some clips with artifacts of the slower ones
+        rng_video_preset = random_utils.get_video_preset_rng(repeatable_random)
+        self.video_preset = str(rng_video_preset.choice(['ultrafast', 'veryfast', 'fast'], p=[0.8, 0.15, 0.05]))
 
     def reinit_second_pass(self):
         self.video_codec = 'libx264'
@@ -89,6 +212,13 @@ class MosaicRandomDegradationParamsV2:
         self.should_add_noise = False
         self.should_run_video_compression_second_pass = False
 
+def _trim_kernel(kernel: np.ndarray, eps=1e-6) -> np.ndarray:
+    # with sigma <= 2 most taps of the 41x41 kernel are practically zero. crop them symmetrically to keep the anchor centered
+    center = kernel.shape[0] // 2
+    ys, xs = np.nonzero(kernel >= eps * kernel.max())
+    radius = max(np.abs(ys - center).max(), np.abs(xs - center).max())
+    return kernel[center - radius:center + radius + 1, center - radius:center + radius + 1]
+
 class MosaicRandomDegradationParams:
     def __init__(self, should_down_sample=True, should_add_noise=True, should_add_image_compression=True, should_add_video_compression=False, should_add_blur=False, repeatable_random=False):
         rng_random, rng_numpy = random_utils.get_rngs(repeatable_random)
@@ -106,6 +236,8 @@ class MosaicRandomDegradationParams:
         self.should_add_jpeg_compression = should_add_image_compression and rng_random.random()<0.5
         jpeg_range = [70, 90]
         self.jpeg_quality = rng_numpy.uniform(jpeg_range[0], jpeg_range[1])
+        # encode params are built once per clip instead of on every frame. quality truncated like the JPEG encoder would do
+        self.jpeg_encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), int(self.jpeg_quality)]
         # video compression
         codecs = {
             "libx264": (15_000, 100_000),
@@ -118,64 +250,128 @@ class MosaicRandomDegradationParams:
         self.should_add_video_compression = should_add_video_compression and rng_random.random()<0.5
         # blur
         self.should_add_blur = should_add_blur and rng_random.random() < 0.5
-        self.blur_kernel = random_mixed_kernels(
-            kernel_list = ('iso', 'aniso'),
-            kernel_prob = (0.5, 0.5),
-            kernel_size = 41,
-            sigma_x_range = (0., 2),
-            sigma_y_range = (0., 2),
-            noise_range=None,
-            repeatable_random=repeatable_random)
+        self.blur_kernel = None
+        self.blur_kernel_separable = False
+        if self.should_add_blur:
+            blur_kernel = random_mixed_kernels(
+                kernel_list = ('iso', 'aniso'),
+                kernel_prob = (0.5, 0.5),
+                kernel_size = 41,
+                sigma_x_range = (0., 2),
+                sigma_y_range = (0., 2),
+                noise_range=None,
+                repeatable_random=repeatable_random)
+            blur_kernel = _trim_kernel(blur_kernel)
+            # isotropic (and axis-aligned anisotropic) gaussian kernels are rank 1 and can be applied as two 1D passes
+            u, s, vt = np.linalg.svd(blur_kernel)
+            self.blur_kernel_separable = len(s) == 1 or s[1] < 1e-6 * s[0]
+            if self.blur_kernel_separable:
+                self.blur_kernel_x = (vt[0] * np.sqrt(s[0])).astype(np.float32)
+                self.blur_kernel_y = (u[:, 0] * np.sqrt(s[0])).astype(np.float32)
+            self.blur_kernel = blur_kernel.astype(np.float32)
+
+_noise_thread_local = threading.local()
 
+def _get_noise_rng_and_buffer(shape) -> tuple[np.random.Generator, np.ndarray]:
+    # frames are degraded on a thread pool. a generator per thread avoids contention on the global RandomState
+    # and the noise buffer is reused as all frames of a clip have the same shape.
+    # the generator is recreated after fork so DataLoader workers don't produce the same noise
+    if getattr(_noise_thread_local, 'pid', None) != os.getpid():
+        _noise_thread_local.rng = np.random.default_rng()
+        _noise_thread_local.buffer = None
+        _noise_thread_local.pid = os.getpid()
+    if _noise_thread_local.buffer is None or _noise_thread_local.buffer.shape != shape:
+        _noise_thread_local.buffer = np.empty(shape, dtype=np.float32)
+    return _noise_thread_local.rng, _noise_thread_local.buffer
+
+def _add_noise_int16(img: np.ndarray, snr):
+    # adds noise in place to an int16 image in uint8 value range.
+    # flooring the noise keeps the same result as truncating a float image on the final cast to uint8
+    rng, noise = _get_noise_rng_and_buffer(img.shape)
+    rng.standard_normal(dtype=np.float32, out=noise)
+    np.multiply(noise, 255 * 10 ** (-snr / 20), out=noise)
+    np.floor(noise, out=noise)
+    np.add(img, noise, out=img, casting='unsafe')
+    np.clip(img, 0, 255, out=img)
 
 def noise(img, snr=50):
-    mean = 0
-    img = img / 255.0
-    noise = np.random.normal(mean, 10 ** (-snr / 20), img.shape)
-    img = np.clip(img + noise, 0, 1)
-    img = (img * 255).astype(np.uint8)
-    return img
+    img = img.astype(np.int16)
+    _add_noise_int16(img, snr)
+    return img.astype(np.uint8)
 
 def apply_frame_degradation(img: Image, degradation_params: MosaicRandomDegradationParams) -> Image:
+    # stays in uint8 value range. OpenCV filter, resize and JPEG codec have native uint8 implementations
     h, w = img.shape[:2]
-    img_lq = img.astype(np.float32) / 255.
+    img_lq = img
     # blur
-    if degradation_params.should_add_blur:
+    if degradation_params.should_add_blur and degradation_params.blur_kernel_separable:
+        img_lq = cv2.sepFilter2D(img_lq, -1, degradation_params.blur_kernel_x, degradation_params.blur_kernel_y)
+    elif degradation_params.should_add_blur:
         img_lq = cv2.filter2D(img_lq, -1, degradation_params.blur_kernel)
     # downsample
     if degradation_params.should_down_sample:
-        img_lq = cv2.resize(img_lq, (int(w // degradation_params.scale), int(h // degradation_params.scale)), interpolation=cv2.INTER_LINEAR)
+        # INTER_AREA for shrinking. with scale < 1 the image gets enlarged where INTER_AREA behaves like INTER_NEAREST
+        interpolation = cv2.INTER_AREA if degradation_params.scale > 1.0 else cv2.INTER_LINEAR
+        img_lq = cv2.resize(img_lq, (int(w // degradation_params.scale), int(h // degradation_params.scale)), interpolation=interpolation)
     # noise
     if degradation_params.should_add_noise:
         noise = generate_gaussian_noise(img_lq, degradation_params.sigma, False, repeatable_random=degradation_params.repeatable_noise)
-        img_lq = np.clip(img_lq + noise, 0, 1)
+        np.multiply(noise, 255., out=noise)
+        np.rint(noise, out=noise)
+        img_lq = img_lq.astype(np.int16)
+        np.add(img_lq, noise, out=img_lq, casting='unsafe')
+        np.clip(img_lq, 0, 255, out=img_lq)
+        img_lq = img_lq.astype(np.uint8)
     # jpeg compression
     if degradation_params.should_add_jpeg_compression:
-        img_lq = add_jpg_compression(img_lq, degradation_params.jpeg_quality)
+        _, encoded_img = cv2.imencode('.jpg', img_lq, degradation_params.jpeg_encode_params)
+        img_lq = cv2.imdecode(encoded_img, cv2.IMREAD_COLOR)
     # scale back up
     if degradation_params.should_down_sample:
         img_lq = cv2.resize(img_lq, (w, h), interpolation=cv2.INTER_LINEAR)
-    img_lq = (img_lq * 255.).astype(np.uint8)
     return img_lq
 
+@functools.lru_cache(maxsize=64)
+def _get_rotation_matrix(w, h, deg) -> np.ndarray:
+    return cv2.getRotationMatrix2D((w/2,h/2),deg,1)
+
 def rotate(img: Image, deg):
     h,w = img.shape[:2]
-    M = cv2.getRotationMatrix2D((w/2,h/2),deg,1)
+    # multiples of 90 degree only need a transpose/flip instead of resampling. positive angles rotate counter-clockwise like in
+    # cv2.getRotationMatrix2D. output keeps the input shape so 90/270 degree can only take this path for square images
+    d = deg % 360
+    if d == 0:
+        return img
+    if d == 180:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if d in (90, 270) and h == w:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE if d == 90 else cv2.ROTATE_90_CLOCKWISE)
+    M = _get_rotation_matrix(w, h, deg)
     img = cv2.warpAffine(img,M,(w,h))
     return img
 
 def apply_frame_degradation_v2(img: Image, degradation_params: MosaicRandomDegradationParamsV2) -> Image:
     img_lq = img
-    if degradation_params.should_add_blur:
-        img_lq = cv2.GaussianBlur(img, (13,13), degradation_params.blur_sigma)
-    if degradation_params.should_add_noise:
+    if degradation_params.should_add_blur and degradation_params.should_add_noise:
+        # blur straight into an int16 buffer so noise can be added in place without another copy of the frame
+        kernel = degradation_params.blur_kernel
+        img_lq = cv2.sepFilter2D(img, cv2.CV_16S, kernel, kernel)
+        _add_noise_int16(img_lq, 50)
+        img_lq = img_lq.astype(np.uint8)
+    elif degradation_params.should_add_blur:
+        kernel = degradation_params.blur_kernel
+        img_lq = cv2.sepFilter2D(img, -1, kernel, kernel)
+    elif degradation_params.should_add_noise:
         img_lq = noise(img_lq, 50)
     return img_lq
 
 def apply_video_degradation(imgs: list[Image], degradation_params: MosaicRandomDegradationParams) -> list[Image]:
-    imgs_lq = []
-    for img in imgs:
-        imgs_lq.append(apply_frame_degradation(img, degradation_params))
+    # repeatable noise draws from a shared RandomState so frames have to be processed in order.
+    # if no frame degradation is enabled the frames are returned as is and dispatching them to the pool would only cost time
+    has_frame_degradation = (degradation_params.should_add_blur or degradation_params.should_down_sample
+                             or degradation_params.should_add_noise or degradation_params.should_add_jpeg_compression)
+    parallel = has_frame_degradation and not (degradation_params.should_add_noise and degradation_params.repeatable_noise)
+    imgs_lq = _map_frames(apply_frame_degradation, imgs, degradation_params, parallel=parallel)
     # video_compression
     if degradation_params.should_add_video_compression:
         imgs_lq = apply_video_compression(imgs_lq, degradation_params.video_codec, degradation_params.video_bitrate)
@@ -183,7 +379,8 @@ def apply_video_degradation(imgs: list[Image], degradation_params: MosaicRandomD
 
 def apply_video_degradation_v2(imgs: list[Image], degradation_params: MosaicRandomDegradationParamsV2) -> list[Image]:
     assert max(imgs[0].shape[:2]) == 256, "video compression degradation expects width/height of 256px"
-    imgs_lq = apply_video_compression(imgs, degradation_params.video_codec, degradation_params.video_bitrate)
-    for i, img in enumerate(imgs_lq):
-        imgs_lq[i] = apply_frame_degradation_v2(img, degradation_params)
+    imgs_lq = apply_video_compression(imgs, degradation_params.video_codec, degradation_params.video_bitrate, degradation_params.video_crf, degradation_params.video_preset)
+    # frames are returned as is without blur and noise, dispatching them to the pool would only cost time
+    parallel = degradation_params.should_add_blur or degradation_params.should_add_noise
+    imgs_lq = _map_frames(apply_frame_degradation_v2, imgs_lq, degradation_params, parallel=parallel)
     return imgs_lq
\ No newline at end of file
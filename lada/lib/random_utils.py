@@ -4,6 +4,8 @@ import numpy as np
 
 repeatable_rng_random = random.Random(42)
 repeatable_rng_numpy = np.random.RandomState(42)
+# separate from repeatable_rng_numpy so sampling the video preset doesn't shift the other degradation parameters of later clips
+repeatable_rng_numpy_video_preset = np.random.RandomState(42)
 
 def get_rngs(repeatable) -> tuple[random, np.random]:
     if repeatable:
@@ -12,4 +14,7 @@ def get_rngs(repeatable) -> tuple[random, np.random]:
     else:
         rng_random = random
         rng_numpy = np.random
-    return rng_random, rng_numpy
\ No newline at end of file
+    return rng_random, rng_numpy
+
+def get_video_preset_rng(repeatable) -> np.random:
+    return repeatable_rng_numpy_video_preset if repeatable else np.random
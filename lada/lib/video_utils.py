@@ -207,10 +207,13 @@ def pad_to_compatible_size_for_video_codecs(imgs):
     h, w = imgs[0].shape[:2]
     pad_h = 0 if h % 4 == 0 else 4 - (h % 4)
     pad_w = 0 if w % 4 == 0 else 4 - (w % 4)
-    if pad_h > 0 or pad_w > 0:
+    if pad_h == 0 and pad_w == 0:
         return imgs
-    else:
-        return [np.pad(img, ((0, pad_h), (0, pad_w), (0,0))).astype(np.uint8) for img in imgs]
+    # zero-padded frames are written into a single block instead of allocating each frame separately
+    padded_imgs = np.zeros((len(imgs), h + pad_h, w + pad_w, imgs[0].shape[2]), dtype=np.uint8)
+    for i, img in enumerate(imgs):
+        padded_imgs[i, :h, :w, :] = img
+    return list(padded_imgs)
 
 @contextmanager
 def VideoReaderOpenCV(*args, **kwargs):